@@ -1,15 +1,17 @@
+import logging
 import serial
-from enum import Enum
+import time
 
 import pwnagotchi.plugins as plugins
 import pwnagotchi.ui.faces as faces
 
-class PwnZeroParam(Enum):
+class PwnZeroParam:
     """
     Flipper Zero Parameters
     These are the parameters that can be changed on the Flipper Zero
     The values are the bytes that are being sent to the Flipper Zero
-    to change the parameter
+    to change the parameter, kept as plain ints so no .value lookup
+    is needed when building frames
     The documentation for the Flipper Zero can be found here:
     https://github.com/Matt-London/pwnagotchi-flipper/blob/main/doc/Protocol.md
     """
@@ -23,7 +25,7 @@ class PwnZeroParam(Enum):
     HANDSHAKES  = 11
     MESSAGE     = 12
 
-class PwnMode(Enum):
+class PwnMode:
         """
         Embedded class with the mode
         """
@@ -31,7 +33,7 @@ class PwnMode(Enum):
         AUTO    = 5
         AI      = 6
 
-class PwnFace(Enum):
+class PwnFace:
     """
     Embedded class with all face parameters
     """
@@ -71,8 +73,41 @@ class PwnZero(plugins.Plugin):
     __license__ = "MIT"
     __description__ = "Plugin to display the Pwnagotchi on the Flipper Zero"
 
-    PROTOCOL_START   = 0x02
-    PROTOCOL_END     = 0x03
+    PROTOCOL_START   = b'\x02'
+    PROTOCOL_END     = b'\x03'
+
+    # The Flipper cannot ask for the current state, so unchanged values are
+    # still resent this often in case the app was (re)opened in between
+    FULL_REFRESH_SECS = 30
+
+    # Initial size of the buffer a UI update's frames are batched in
+    WRITE_BUFFER_SIZE = 512
+
+    # How long to stop writing after the serial port failed
+    FAILURE_BACKOFF_SECS = 5
+
+    # OS serial buffer sizes to request, where the platform supports it
+    OS_BUFFER_SIZE = 4096
+
+    # Bytes waiting in the OS output queue above which the face and message
+    # are skipped for this update instead of blocking the pwnagotchi
+    TX_BACKLOG_LIMIT = 2048
+
+    # Pwnagotchi mode string to PwnMode
+    _MODE_MAPPING = {
+        'AI': PwnMode.AI,
+        'AUTO': PwnMode.AUTO,
+        'MANUAL': PwnMode.MANU,
+        'MANU': PwnMode.MANU,
+    }
+
+    # Faces shared by pwnagotchi.ui.faces and PwnFace under the same name
+    _FACE_NAMES = (
+        'LOOK_R', 'LOOK_L', 'LOOK_R_HAPPY', 'LOOK_L_HAPPY', 'SLEEP', 'SLEEP2',
+        'AWAKE', 'BORED', 'INTENSE', 'COOL', 'HAPPY', 'GRATEFUL', 'EXCITED',
+        'MOTIVATED', 'DEMOTIVATED', 'SMART', 'LONELY', 'SAD', 'ANGRY',
+        'FRIEND', 'BROKEN', 'DEBUG', 'UPLOAD', 'UPLOAD1', 'UPLOAD2',
+    )
 
     def __init__(self, port: str = "/dev/serial0", baud: int = 115200):
         """
@@ -86,40 +121,105 @@ class PwnZero(plugins.Plugin):
 
         try:
             # open serial connection to Flipper Zero
-            self._serialConn = serial.Serial(port, baud)
+            self._serialConn = serial.Serial(port, baud, write_timeout=None)
         except Exception as e:
             # propagate as runtime error for plugin loader
             raise RuntimeError(f"Cannot bind to port {port} with baud {baud}: {e}")
 
+        try:
+            # only available on Windows
+            self._serialConn.set_buffer_size(rx_size=self.OS_BUFFER_SIZE, tx_size=self.OS_BUFFER_SIZE)
+        except (AttributeError, serial.SerialException):
+            pass
+
+        self._load_faces()
+
+        # Faces and modes only have a handful of values, build their frames once
+        self._face_frames = {
+            f: self._build_frame(PwnZeroParam.FACE, bytes((f,)))
+            for f in self._codes(PwnFace)
+        }
+        self._mode_frames = {
+            m: self._build_frame(PwnZeroParam.MODE, bytes((m,)))
+            for m in self._codes(PwnMode)
+        }
+
+        # Last frame sent for each parameter
+        self._last: dict[int, bytes] = {}
+        self._next_refresh = time.monotonic() + self.FULL_REFRESH_SECS
+
+        # Last UI value and the frame built from it, for each parameter
+        self._field_frames: dict[int, tuple] = {}
+
+        # UI fields sent as text when present: key, parameter, converter
+        self._text_fields = (
+            ('channel', PwnZeroParam.CHANNEL, self._value_to_bytes),
+            ('uptime', PwnZeroParam.UPTIME, self._value_to_bytes),
+            ('name', PwnZeroParam.NAME, self._name_to_bytes),
+        )
+        # UI fields holding a (session, total) pair, always sent
+        self._pair_fields = (
+            ('aps', PwnZeroParam.APS),
+            ('shakes', PwnZeroParam.HANDSHAKES),
+        )
+
+        # time.monotonic() until which writes are skipped after a failure
+        self._fail_until = 0.0
+
+        # Frames queued during a UI update are assembled in one reusable
+        # buffer, _batch_len is how much of it is used or None when not batching
+        self._scratch = bytearray(self.WRITE_BUFFER_SIZE)
+        self._batch_len = None
+
+    @staticmethod
+    def _codes(cls) -> list:
+        """
+        Lists all codes defined on one of the code classes above
+
+        :param: cls: PwnFace or PwnMode
+        :return: List of the int codes
+        """
+        return [v for k, v in vars(cls).items() if k.isupper() and isinstance(v, int)]
+
+    def _load_faces(self):
+        """
+        Builds the lookup from the current pwnagotchi face strings to PwnFace
+        """
+        self._face_mapping = {getattr(faces, name): getattr(PwnFace, name) for name in self._FACE_NAMES}
+
     def close(self):
         """
         Closes the connection to the Flipper Zero
         """
         self._serialConn.close()
 
-    def _is_byte(self, i: int) -> bool:
+    def _str_to_bytes(self, s: str) -> bytes:
         """
-        Checks if a passed in integer is a valid byte (0 <= i < 256)
+        Converts a string into bytes, characters outside of latin-1 are
+        replaced with '?'
 
-        :param: i: Integer to check
-        :return: If it is a valid byte
+        :param: s: String to convert
+        :return: Encoded bytes
         """
-        return 0 <= i < 256
+        return s.encode('latin-1', 'replace')
 
-    def _str_to_bytes(self, s: str):
+    def _build_frame(self, param: int, args: bytes):
         """
-        Converts a string into a list of bytes
+        Builds a protocol v2 frame for the Flipper Zero
 
-        :param: s: String to convert
-        :return: List of bytes
+        :param: param: Parameter that is being changed
+        :param: args: Arguments to pass to the flipper
+        :return: Frame as bytes, None if param is not a valid byte
         """
-        retVal = []
-        for c in s:
-            retVal.append(ord(c))
-        
-        return retVal
+        # bytes() rejects a param that is not a valid byte
+        try:
+            head = self.PROTOCOL_START + bytes((param,))
+        except ValueError:
+            return None
 
-    def _send_data(self, param: int, args) -> bool:
+        return head + args + self.PROTOCOL_END
+
+    def _send_data(self, param: int, args: bytes) -> bool:
         """
         Sends data using protocol v2 over the serial port to the Flipper Zero
 
@@ -127,37 +227,158 @@ class PwnZero(plugins.Plugin):
         :param: args: Arguments to pass to the flipper
         :return: If transmission was successful
         """
-        # Make sure everything is a valid byte
-        if not self._is_byte(param):
+        frame = self._build_frame(param, args)
+        if frame is None:
             return False
-        for i in args:
-            if not self._is_byte(i):
+
+        return self._write_frame(param, frame)
+
+    def _send_cached(self, param: int, raw, to_bytes) -> bool:
+        """
+        Sends a value from the UI, reusing the frame built for it last time
+        when the value has not changed
+
+        :param: param: Parameter that is being changed
+        :param: raw: Value as read from the UI, must be immutable
+        :param: to_bytes: Converts raw into the arguments for the flipper
+        :return: If transmission was successful
+        """
+        cached = self._field_frames.get(param)
+        if cached is not None and (cached[0] is raw or cached[0] == raw):
+            frame = cached[1]
+        else:
+            frame = self._build_frame(param, to_bytes(raw))
+            if frame is None:
                 return False
-        
-        # Now we know everything is a valid byte
-        
-        # Build the sending data
-        data = [self.PROTOCOL_START]
-        data.append(param)
-        for arg in args:
-            data.append(arg)
-        
-        data.append(self.PROTOCOL_END)
+            self._field_frames[param] = (raw, frame)
+
+        return self._write_frame(param, frame)
+
+    def _value_to_bytes(self, value) -> bytes:
+        """
+        Converts a plain UI value like the channel or uptime into arguments
+
+        :param: value: Value as read from the UI
+        :return: Encoded bytes
+        """
+        return self._str_to_bytes(str(value))
+
+    def _name_to_bytes(self, name) -> bytes:
+        """
+        Converts the UI name into arguments, without the trailing '>'
 
-        # Send data to flipper as bytes
-        data_bytes = bytes(data)
-        written = self._serialConn.write(data_bytes)
-        return written == len(data_bytes)
+        :param: name: Name as read from the UI
+        :return: Encoded bytes
+        """
+        return self._str_to_bytes(str(name)).translate(None, b'>')
+
+    def _pair_to_bytes(self, value) -> bytes:
+        """
+        Converts a UI value that is either a string or a (session, total)
+        pair like APS and handshakes into arguments
+
+        :param: value: Value as read from the UI
+        :return: Encoded bytes
+        """
+        if isinstance(value, tuple) and len(value) >= 2:
+            value = f"{value[0]} ({value[1]})"
+        return self._str_to_bytes(str(value) if value is not None else '')
+
+    def _write_frame(self, param: int, frame: bytes) -> bool:
+        """
+        Writes a complete frame unless the Flipper already shows it
+
+        :param: param: Parameter that the frame changes
+        :param: frame: Frame to send, including start and end byte
+        :return: If transmission was successful
+        """
+        # The Flipper already shows this value
+        if self._last.get(param) == frame:
+            return True
+
+        # Queue it up if a batch is open, it is checked in _end_batch
+        if self._batch_len is not None:
+            end = self._batch_len + len(frame)
+            # Grows the buffer if the frames don't fit yet
+            self._scratch[self._batch_len:end] = frame
+            self._batch_len = end
+            self._last[param] = frame
+            return True
+
+        # Send data to flipper
+        if not self._write(frame):
+            self._last.pop(param, None)
+            return False
+
+        self._last[param] = frame
+        return True
+
+    def _tx_backlogged(self) -> bool:
+        """
+        Checks if the Flipper is falling behind on reading what we sent
+
+        :return: If the OS output queue is above TX_BACKLOG_LIMIT
+        """
+        try:
+            return self._serialConn.out_waiting > self.TX_BACKLOG_LIMIT
+        except (AttributeError, OSError, serial.SerialException):
+            # Can't tell on this platform
+            return False
+
+    def _write(self, data) -> bool:
+        """
+        Writes data to the serial port, backing off for FAILURE_BACKOFF_SECS
+        once the port fails (e.g. the Flipper was disconnected)
+
+        :param: data: Bytes to write
+        :return: If data was written
+        """
+        if time.monotonic() < self._fail_until:
+            return False
+
+        # The port is blocking, write either takes everything or raises
+        try:
+            self._serialConn.write(data)
+        except (OSError, serial.SerialException) as e:
+            logging.warning(f"[PwnZero] Writing to {self._port} failed, retrying in {self.FAILURE_BACKOFF_SECS}s: {e}")
+            self._fail_until = time.monotonic() + self.FAILURE_BACKOFF_SECS
+            return False
+
+        return True
+
+    def _begin_batch(self):
+        """
+        Starts collecting frames so they can be sent with a single write
+        """
+        self._batch_len = 0
+
+    def _end_batch(self) -> bool:
+        """
+        Sends all frames collected since _begin_batch
+
+        :return: If transmission was successful
+        """
+        length = self._batch_len
+        self._batch_len = None
+        if not length:
+            return True
+
+        if not self._write(memoryview(self._scratch)[:length]):
+            # The port may have taken part of the batch before failing and
+            # nothing of it is kept, so send every value again next time
+            self._last.clear()
+            return False
+        return True
 
     # Public method commands
-    def set_face(self, face: PwnFace) -> bool:
+    def set_face(self, face: int) -> bool:
         """
         Set the face of the Pwnagotchi
 
-        :param: face: Face to set on the device
+        :param: face: Face to set on the device (one of PwnFace)
         :return: If the command was sent successfully
         """
-        return self._send_data(PwnZeroParam.FACE.value, [face.value])
+        return self._write_frame(PwnZeroParam.FACE, self._face_frames[face])
 
     def set_name(self, name: str) -> bool:
         """
@@ -167,7 +388,7 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(name)
-        return self._send_data(PwnZeroParam.NAME.value, data)
+        return self._send_data(PwnZeroParam.NAME, data)
 
     def set_channel(self, channelInfo: str) -> bool:
         """
@@ -178,7 +399,7 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(channelInfo)
-        return self._send_data(PwnZeroParam.CHANNEL.value, data)
+        return self._send_data(PwnZeroParam.CHANNEL, data)
 
     def set_aps(self, apsInfo: str) -> bool:
         """
@@ -188,7 +409,7 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(apsInfo)
-        return self._send_data(PwnZeroParam.APS.value, data)
+        return self._send_data(PwnZeroParam.APS, data)
 
     def set_uptime(self, uptimeInfo: str) -> bool:
         """
@@ -198,7 +419,7 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(uptimeInfo)
-        return self._send_data(PwnZeroParam.UPTIME.value, data)
+        return self._send_data(PwnZeroParam.UPTIME, data)
 
     def set_friend(self) -> bool:
         """
@@ -208,14 +429,14 @@ class PwnZero(plugins.Plugin):
         """
         return False
 
-    def set_mode(self, mode: PwnMode) -> bool:
+    def set_mode(self, mode: int) -> bool:
         """
         Set the mode on the Pwnagotchi
         
-        :param: mode: Mode to set
+        :param: mode: Mode to set (one of PwnMode)
         :return: If the command was sent successfully
         """
-        return self._send_data(PwnZeroParam.MODE.value, [mode.value])
+        return self._write_frame(PwnZeroParam.MODE, self._mode_frames[mode])
 
     def set_handshakes(self, handshakesInfo: str) -> bool:
         """
@@ -225,7 +446,7 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(handshakesInfo)
-        return self._send_data(PwnZeroParam.HANDSHAKES.value, data)
+        return self._send_data(PwnZeroParam.HANDSHAKES, data)
 
     def set_message(self, message: str) -> bool:
         """
@@ -235,92 +456,59 @@ class PwnZero(plugins.Plugin):
         :return: If the command was sent successfully
         """
         data = self._str_to_bytes(message)
-        return self._send_data(PwnZeroParam.MESSAGE.value, data)
+        return self._send_data(PwnZeroParam.MESSAGE, data)
 
     def on_ui_setup(self, ui):
-        pass
+        # Faces can be overridden from the config once the view is set up,
+        # so rebuild the lookup against the final face strings
+        self._load_faces()
 
     def on_ui_update(self, ui):
-        # Status message
-        status = ui.get('status')
-        if status is not None:
-            self.set_message(str(status))
-
-        # Mode mapping
-        mode_str = ui.get('mode')
-        if isinstance(mode_str, str):
-            mode_key = mode_str.upper()
-        else:
-            mode_key = None
-        mode_mapping = {
-            'AI': PwnMode.AI,
-            'AUTO': PwnMode.AUTO,
-            'MANUAL': PwnMode.MANU,
-            'MANU': PwnMode.MANU,
-        }
-        mode = mode_mapping.get(mode_key)
-        if mode:
-            self.set_mode(mode)
-
-        # Channel
-        channel = ui.get('channel')
-        if channel is not None:
-            self.set_channel(str(channel))
-
-        # Uptime
-        uptime = ui.get('uptime')
-        if uptime is not None:
-            self.set_uptime(str(uptime))
-
-        # APS (could be tuple or string)
-        aps = ui.get('aps')
-        if isinstance(aps, (tuple, list)) and len(aps) >= 2:
-            aps_str = f"{aps[0]} ({aps[1]})"
-        else:
-            aps_str = str(aps) if aps is not None else ''
-        self.set_aps(aps_str)
-
-        # Name (sanitize > char)
-        name = ui.get('name')
-        if name is not None:
-            self.set_name(str(name).replace('>', ''))
-
-        # Face mapping (fallback to default face)
-        face = ui.get('face')
-        face_mapping = {
-            faces.LOOK_R: PwnFace.LOOK_R,
-            faces.LOOK_L: PwnFace.LOOK_L,
-            faces.LOOK_R_HAPPY: PwnFace.LOOK_R_HAPPY,
-            faces.LOOK_L_HAPPY: PwnFace.LOOK_L_HAPPY,
-            faces.SLEEP: PwnFace.SLEEP,
-            faces.SLEEP2: PwnFace.SLEEP2,
-            faces.AWAKE: PwnFace.AWAKE,
-            faces.BORED: PwnFace.BORED,
-            faces.INTENSE: PwnFace.INTENSE,
-            faces.COOL: PwnFace.COOL,
-            faces.HAPPY: PwnFace.HAPPY,
-            faces.GRATEFUL: PwnFace.GRATEFUL,
-            faces.EXCITED: PwnFace.EXCITED,
-            faces.MOTIVATED: PwnFace.MOTIVATED,
-            faces.DEMOTIVATED: PwnFace.DEMOTIVATED,
-            faces.SMART: PwnFace.SMART,
-            faces.LONELY: PwnFace.LONELY,
-            faces.SAD: PwnFace.SAD,
-            faces.ANGRY: PwnFace.ANGRY,
-            faces.FRIEND: PwnFace.FRIEND,
-            faces.BROKEN: PwnFace.BROKEN,
-            faces.DEBUG: PwnFace.DEBUG,
-            faces.UPLOAD: PwnFace.UPLOAD,
-            faces.UPLOAD1: PwnFace.UPLOAD1,
-            faces.UPLOAD2: PwnFace.UPLOAD2,
-        }
-        face_enum = face_mapping.get(face, PwnFace.DEFAULT_FACE)
-        self.set_face(face_enum)
+        now = time.monotonic()
+        # Don't bother building frames while the port is down
+        if now < self._fail_until:
+            return
 
-        # Handshakes (could be tuple or string)
-        shakes = ui.get('shakes')
-        if isinstance(shakes, (tuple, list)) and len(shakes) >= 2:
-            shakes_str = f"{shakes[0]} ({shakes[1]})"
-        else:
-            shakes_str = str(shakes) if shakes is not None else ''
-        self.set_handshakes(shakes_str)
+        if now >= self._next_refresh:
+            self._last.clear()
+            self._next_refresh = now + self.FULL_REFRESH_SECS
+
+        # Face and message are dropped while the Flipper is behind, they are
+        # sent again once it catches up
+        backlogged = self._tx_backlogged()
+
+        g = ui.get
+        send_cached = self._send_cached
+
+        self._begin_batch()
+        try:
+            # Status message
+            status = g('status')
+            if status is not None and not backlogged:
+                self.set_message(str(status))
+
+            # Mode mapping
+            mode_str = g('mode')
+            if isinstance(mode_str, str):
+                mode = self._MODE_MAPPING.get(mode_str.upper())
+                if mode:
+                    self.set_mode(mode)
+
+            # Channel, uptime and name (sanitize > char)
+            for key, param, to_bytes in self._text_fields:
+                value = g(key)
+                if value is not None:
+                    send_cached(param, value, to_bytes)
+
+            # APS and handshakes (could be tuple or string)
+            for key, param in self._pair_fields:
+                value = g(key)
+                if isinstance(value, list):
+                    value = tuple(value)
+                send_cached(param, value, self._pair_to_bytes)
+
+            # Face mapping (fallback to default face)
+            if not backlogged:
+                self.set_face(self._face_mapping.get(g('face'), PwnFace.DEFAULT_FACE))
+        finally:
+            self._end_batch()